@@ -1,13 +1,49 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import functools
+import operator
 import re
 import sys
 import unicodedata
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
+# Opcodes of the compiled instruction tuples produced by _compile_block.
+OP_ASSIGN = 0  # (OP_ASSIGN, slot, expr, lineno, raw)
+OP_ASSIGN_CONST = 1  # (OP_ASSIGN_CONST, slot, value, lineno, raw)
+OP_ADD = 2  # (OP_ADD, x, y, slot, lineno, raw); likewise OP_SUB, OP_MUL, OP_DIV
+OP_SUB = 3
+OP_MUL = 4
+OP_DIV = 5
+OP_PRINT = 6  # (OP_PRINT, expr, lineno, raw)
+OP_RETURN = 7  # (OP_RETURN, expr, lineno, raw)
+OP_LOOP = 8  # (OP_LOOP, count_expr, body, lineno, numeric)
+OP_IF = 9  # (OP_IF, cond_expr, then_body, else_body, is_zero, lineno)
+OP_FUNC = 10  # (OP_FUNC, name, params, compiled_body, param_slots, frame_slots)
 
+_ARITH = {OP_ADD: operator.add, OP_SUB: operator.sub, OP_MUL: operator.mul, OP_DIV: operator.truediv}
+_NUM = (int, float)
+
+# Arithmetic is folded at compile time only while ints stay within this many
+# bits, so compiling never costs more than a few machine-sized operations.
+_FOLD_MAX_BITS = 256
+
+Instr = Tuple[Any, ...]
+
+# Token classes cached by KeiyakuInterpreter._value_of.
+TOK_CONST = 0  # payload: literal value
+TOK_VAR = 1  # payload: env slot
+TOK_CALL = 2  # payload: (name, arg_tokens, token)
+
+# Value of an env slot whose variable has not been assigned.
+_UNSET = object()
+
+
+@functools.lru_cache(maxsize=8192)
 def normalize_text(s: str) -> str:
+    # ASCII is unchanged by NFKC, so such lines only need the whitespace cleanup
+    if s.isascii() and "  " not in s and s == s.strip():
+        return s
     s = unicodedata.normalize("NFKC", s)
     s = s.replace("\u3000", " ")
     return re.sub(r"[ ]+", " ", s.strip())
@@ -26,71 +62,131 @@ class KeiyakuInterpreter:
     _re_div1 = re.compile(r"^(?P<x>.+)を (?P<y>.+) で除した数を (?P<z>.+) とする。?$")
     _re_div2 = re.compile(r"^(?P<x>.+)を (?P<y>.+) で割った数を (?P<z>.+) とする。?$")
     _re_loop_start = re.compile(r"^(?P<count>.+) 回、以下を行う。?$")
-    _re_loop_end = re.compile(r"^以上。?$")
     _re_return = re.compile(r"^(?P<expr>.+)を返す。?$")
     _re_if_zero = re.compile(r"^もし (?P<expr>.+) が 0 なら(?:ば)?、以下を行う。?$")
     _re_if_nonzero = re.compile(r"^もし (?P<expr>.+) が 0 でなければ、以下を行う。?$")
-    _re_else = re.compile(r"^そうでなければ(?:、以下を行う。?)?$")
+    _re_func_def = re.compile(r"^(?:関数 )?(?P<name>[^\s()]+)\((?P<params>[^)]*)\) を(?:関数として)?定義する。?$")
+    # Any line that opens or closes a block; the kind is reported by lastgroup.
+    _re_structural = re.compile(
+        r"^(?:(?P<func>(?:関数 )?[^\s()]+\([^)]*\) を(?:関数として)?定義する。?)"
+        r"|(?P<loop>.+ 回、以下を行う。?)"
+        r"|(?P<if0>もし .+ が 0 なら(?:ば)?、以下を行う。?)"
+        r"|(?P<ifnz>もし .+ が 0 でなければ、以下を行う。?)"
+        r"|(?P<else>そうでなければ(?:、以下を行う。?)?)"
+        r"|(?P<end>以上。?))$"
+    )
+    _re_call = re.compile(r"(?P<name>[^\s()]+)\((?P<args>.*)\)")
+    _re_float = re.compile(r"[+-]?(?:\d+\.\d*|\d*\.\d+)")
+    _re_arg_token = re.compile(r'"[^"]*"?|「[^」]*」?|[(),]|[^,"「()]+')
+    # (keyword, regex, opcode) tried in order by _compile_line
+    _dispatch = [
+        ("を加えた数を", _re_add, OP_ADD),
+        ("を減じた数を", _re_sub1, OP_SUB),
+        ("を差し引いた数を", _re_sub2, OP_SUB),
+        ("の積を", _re_mul, OP_MUL),
+        ("で除した数を", _re_div1, OP_DIV),
+        ("で割った数を", _re_div2, OP_DIV),
+        ("とする", _re_assign, OP_ASSIGN),
+        ("を出力する", _re_print, OP_PRINT),
+        ("を返す", _re_return, OP_RETURN),
+    ]
 
     def __init__(self) -> None:
-        self.env: Dict[str, Any] = {}
+        # Variables live in env slots; _symtab maps each name to its slot and
+        # _names maps slots back to names.
+        self.env: list[Any] = []
+        self._symtab: Dict[str, int] = {}
+        self._names: list[str] = []
         self.outputs = []
+        # Printed text waiting to be written to stdout; see _flush_output
+        self._out_buf: list[str] = []
+        self._out_size = 0
+        self._buffer_output = False
         self.funcs: Dict[str, Dict[str, Any]] = {}
         self._toplevel_effect = False
+        # token -> (TOK_*, payload); tokens are immutable so entries never go stale
+        self._token_cache: Dict[str, Tuple[int, Any]] = {}
 
-    def _value_of(self, token: str) -> Any:
+    def _classify(self, token: str) -> Tuple[int, Any]:
         token = token.strip()
-        m_call = re.fullmatch(r"(?P<name>[^\s()]+)\((?P<args>.*)\)", token)
-        if m_call and m_call.group("name") in self.funcs:
-            name = m_call.group("name")
+        m_call = self._re_call.fullmatch(token)
+        if m_call:
             args_raw = m_call.group("args").strip()
             args_list = []
             if args_raw:
                 args_list = [a.strip() for a in self._split_args(args_raw)]
-            arg_vals = [self._value_of(a) for a in args_list]
-            return self._call_function(name, arg_vals)
+            return TOK_CALL, (m_call.group("name"), args_list, token)
         if (token.startswith("「") and token.endswith("」")) or (
             token.startswith("\"") and token.endswith("\"")
         ):
-            return token[1:-1]
-        if re.fullmatch(r"[+-]?\d+", token):
-            return int(token)
-        if re.fullmatch(r"[+-]?(?:\d+\.\d*|\d*\.\d+)", token):
-            return float(token)
-        if token in self.env:
-            return self.env[token]
-        raise NameError(f"未定義の識別子または解釈できない値です: {token}")
+            return TOK_CONST, token[1:-1]
+        digits = token[1:] if token[:1] in ("+", "-") else token
+        if digits.isdecimal():
+            return TOK_CONST, int(token)
+        if self._re_float.fullmatch(token):
+            return TOK_CONST, float(token)
+        return TOK_VAR, self._slot(token)
+
+    def _token(self, token: str) -> Tuple[int, Any]:
+        entry = self._token_cache.get(token)
+        if entry is None:
+            entry = self._token_cache[token] = self._classify(token)
+        return entry
+
+    def _slot(self, name: str) -> int:
+        slot = self._symtab.get(name)
+        if slot is None:
+            slot = self._symtab[name] = len(self._names)
+            self._names.append(name)
+            self.env.append(_UNSET)
+        return slot
+
+    def _target(self, name: str) -> int:
+        name = name.strip()
+        if not name:
+            raise ValueError("空の識別子には代入できません")
+        return self._slot(name)
+
+    def _value_of(self, token: str) -> Any:
+        # Same lookup as _token, inlined because this runs for every operand
+        entry = self._token_cache.get(token)
+        if entry is None:
+            entry = self._token_cache[token] = self._classify(token)
+        tag, payload = entry
+        if tag == TOK_VAR:
+            val = self.env[payload]
+            if val is not _UNSET:
+                return val
+            payload = self._names[payload]
+        elif tag == TOK_CONST:
+            return payload
+        else:
+            name, args_list, payload = payload
+            if name in self.funcs:
+                arg_vals = [self._value_of(a) for a in args_list]
+                return self._call_function(name, arg_vals)
+            slot = self._symtab.get(payload)
+            if slot is not None and self.env[slot] is not _UNSET:
+                return self.env[slot]
+        raise NameError(f"未定義の識別子または解釈できない値です: {payload}")
 
     def _split_args(self, s: str) -> list[str]:
         args = []
         buf = []
         depth_paren = 0
-        in_dq = False
-        in_jq = False
-        i = 0
-        while i < len(s):
-            ch = s[i]
-            if ch == '"' and not in_jq:
-                in_dq = not in_dq
-                buf.append(ch)
-            elif ch == '「' and not in_dq:
-                in_jq = True
-                buf.append(ch)
-            elif ch == '」' and in_jq:
-                in_jq = False
-                buf.append(ch)
-            elif ch == '(' and not in_dq and not in_jq:
+        # Quoted strings arrive as single tokens, so only parentheses and
+        # commas need tracking here.
+        for tok in self._re_arg_token.findall(s):
+            if tok == ",":
+                if depth_paren == 0:
+                    args.append(''.join(buf).strip())
+                    buf = []
+                    continue
+            elif tok == "(":
                 depth_paren += 1
-                buf.append(ch)
-            elif ch == ')' and not in_dq and not in_jq and depth_paren > 0:
+            elif tok == ")" and depth_paren > 0:
                 depth_paren -= 1
-                buf.append(ch)
-            elif ch == ',' and not in_dq and not in_jq and depth_paren == 0:
-                args.append(''.join(buf).strip())
-                buf = []
-            else:
-                buf.append(ch)
-            i += 1
+            buf.append(tok)
         if buf:
             args.append(''.join(buf).strip())
         return args
@@ -104,323 +200,407 @@ class KeiyakuInterpreter:
         if name not in self.funcs:
             raise NameError(f"未定義の関数です: {name}")
         params = self.funcs[name]["params"]
-        body_lines = self.funcs[name]["body"]
+        compiled = self.funcs[name]["compiled"]
         if len(params) != len(arg_vals):
             raise TypeError(f"関数 {name} の引数個数が一致しません: 期待 {len(params)} 実際 {len(arg_vals)}")
-        saved_env = dict(self.env)
+        # The body can only write its parameters and assignment targets, so
+        # saving those slots is enough to undo the call's effects on env.
+        env = self.env
+        frame = self.funcs[name]["frame"]
+        saved = [env[slot] for slot in frame]
         try:
-            for p, v in zip(params, arg_vals):
-                self.env[p] = v
-            src = "\n".join(body_lines)
+            for slot, v in zip(self.funcs[name]["slots"], arg_vals):
+                env[slot] = v
             try:
-                self.exec(src)
+                self._run(compiled)
             except KeiyakuInterpreter._ReturnSignal as rs:  # type: ignore
                 return rs.value
             return None
         finally:
-            self.env = saved_env
-
-    def _assign(self, name: str, value: Any) -> None:
-        name = name.strip()
-        if not name:
-            raise ValueError("空の識別子には代入できません")
-        self.env[name] = value
-
-    def _binary_numeric(self, x: str, y: str, op: str) -> Any:
-        xv = self._value_of(x)
-        yv = self._value_of(y)
-        if not isinstance(xv, (int, float)) or not isinstance(yv, (int, float)):
-            raise TypeError("数値演算の対象は数値である必要があります")
-        if op == "+":
-            return xv + yv
-        if op == "-":
-            return xv - yv
-        if op == "*":
-            return xv * yv
-        if op == "/":
-            return xv / yv
-        raise ValueError(f"未知の演算: {op}")
+            for slot, v in zip(frame, saved):
+                env[slot] = v
 
-    def exec_line(self, raw: str) -> Optional[bool]:
+    def _compile_line(self, raw: str, lineno: Optional[int]) -> Optional[Instr]:
         line = normalize_text(raw)
         if not line:
             return None
         if line.startswith("※") or line.startswith("(注)") or line.startswith("（注）"):
             return None
+        raw_s = raw.strip()
 
         # 1) Alias definition: <lhs>（以下「<alias>」という。）
-        m = self._re_alias.search(line)
-        if m:
-            lhs = m.group("lhs").strip()
-            alias = m.group("alias").strip()
-            val = self._value_of(lhs)
-            self._assign(alias, val)
-            return True
-
-        # 2) Arithmetic forms
-        for regex, op in [
-            (self._re_add, "+"),
-            (self._re_sub1, "-"),
-            (self._re_sub2, "-"),
-            (self._re_mul, "*"),
-            (self._re_div1, "/"),
-            (self._re_div2, "/"),
-        ]:
-            m2 = regex.match(line)
-            if m2:
-                x, y, z = m2.group("x").strip(), m2.group("y").strip(), m2.group("z").strip()
-                val = self._binary_numeric(x, y, op)
-                self._assign(z, val)
-                return True
-
-        # 3) Assignment: A は B とする。
-        m = self._re_assign.match(line)
-        if m:
-            var = m.group("var").strip()
-            expr = m.group("expr").strip()
-            val = self._value_of(expr)
-            self._assign(var, val)
-            return True
-
-        # 4) Print: A を出力する。
-        m = self._re_print.match(line)
-        if m:
-            var = m.group("var").strip()
-            val = self._value_of(var)
-            self.outputs.append(val)
-            print(val)
-            return True
+        if "という" in line:
+            m = self._re_alias.search(line)
+            if m:
+                return (OP_ASSIGN, self._target(m.group("alias")), m.group("lhs").strip(), lineno, raw_s)
 
-        # 5) Return: A を返す。
-        m = self._re_return.match(line)
-        if m:
-            expr = m.group("expr").strip()
-            val = self._value_of(expr)
-            raise KeiyakuInterpreter._ReturnSignal(val)
+        # 2) Arithmetic, assignment, print and return forms. Each form carries
+        # a distinctive keyword, so a substring test picks the candidate before
+        # its regex is run.
+        for needle, regex, op in self._dispatch:
+            if needle not in line:
+                continue
+            m = regex.match(line)
+            if not m:
+                continue
+            if op == OP_ASSIGN:
+                # A は B とする。
+                return (OP_ASSIGN, self._target(m.group("var")), m.group("expr").strip(), lineno, raw_s)
+            if op == OP_PRINT:
+                # A を出力する。
+                return (OP_PRINT, m.group("var").strip(), lineno, raw_s)
+            if op == OP_RETURN:
+                # A を返す。
+                return (OP_RETURN, m.group("expr").strip(), lineno, raw_s)
+            x, y = m.group("x").strip(), m.group("y").strip()
+            return (op, x, y, self._target(m.group("z")), lineno, raw_s)
 
         # Not matched
-        raise SyntaxError(f"解釈できない文です: {raw.strip()}")
+        where = f" (行 {lineno})" if lineno is not None else ""
+        raise SyntaxError(f"解釈できない文です: {raw_s}{where}")
 
-    def exec(self, program: str, *, is_toplevel: bool = False) -> None:
-        lines = program.splitlines()
-        i = 0
-        lineno = 0
-        while i < len(lines):
-            raw = lines[i]
-            lineno += 1
-            raw_s = raw.rstrip()
-            if not raw_s:
+    def _exec_simple(self, instr: Instr) -> None:
+        op = instr[0]
+        arith = _ARITH.get(op)
+        if arith is not None:
+            xv = self._value_of(instr[1])
+            yv = self._value_of(instr[2])
+            if type(xv) not in _NUM or type(yv) not in _NUM:
+                raise TypeError("数値演算の対象は数値である必要があります")
+            self.env[instr[3]] = arith(xv, yv)
+        elif op == OP_ASSIGN_CONST:
+            self.env[instr[1]] = instr[2]
+        elif op == OP_ASSIGN:
+            self.env[instr[1]] = self._value_of(instr[2])
+        elif op == OP_PRINT:
+            val = self._value_of(instr[1])
+            self.outputs.append(val)
+            if self._buffer_output:
+                text = f"{val}\n"
+                self._out_buf.append(text)
+                self._out_size += len(text)
+                if self._out_size >= 4096:
+                    self._flush_output()
+            else:
+                print(val)
+        elif op == OP_RETURN:
+            raise KeiyakuInterpreter._ReturnSignal(self._value_of(instr[1]))
+        else:
+            raise ValueError(f"未知の命令: {op}")
+
+    def exec_line(self, raw: str) -> Optional[bool]:
+        instr = self._compile_line(raw, None)
+        if instr is None:
+            return None
+        try:
+            self._exec_simple(instr)
+        finally:
+            self._flush_output()
+        return True
+
+    def _flush_output(self) -> None:
+        if self._out_buf:
+            sys.stdout.write("".join(self._out_buf))
+            self._out_buf.clear()
+            self._out_size = 0
+
+    def _build_jump_table(self, lines: list[str]) -> Dict[int, int]:
+        """Map the index of every block opener to the index of its closing 以上。
+
+        ``lines`` must already be normalized. Openers left unclosed get no entry.
+        """
+        jumps: Dict[int, int] = {}
+        stack: list[int] = []
+        for i, line in enumerate(lines):
+            m = self._re_structural.match(line)
+            if not m:
+                continue
+            if m.lastgroup != "end":
+                stack.append(i)
+            elif stack:
+                jumps[stack.pop()] = i
+        return jumps
+
+    def _compile_block(self, lines: list[str]) -> list[Instr]:
+        """Parse ``lines`` once into a list of instruction tuples."""
+        norm = [normalize_text(raw.rstrip()) for raw in lines]
+        return self._compile_range(lines, norm, self._build_jump_table(norm), 0, len(lines))
+
+    def _compile_range(
+        self, lines: list[str], norm: list[str], jumps: Dict[int, int], start: int, stop: int
+    ) -> list[Instr]:
+        code: list[Instr] = []
+        # Slots holding a known constant at this point of the straight-line code
+        known: Dict[int, Any] = {}
+        i = start
+        while i < stop:
+            line = norm[i]
+            lineno = i + 1
+            if not line:
                 i += 1
                 continue
-            line = normalize_text(raw_s)
+            m = self._re_structural.match(line)
+            kind = m.lastgroup if m else None
             # Function definition block: <Name>(args) を関数として定義する。
-            m_func = re.match(r"^(?:関数 )?(?P<name>[^\s()]+)\((?P<params>[^)]*)\) を(?:関数として)?定義する。?$", line)
-            if m_func:
+            if kind == "func":
+                m_func = self._re_func_def.match(line)
                 fname = m_func.group("name").strip()
                 params_raw = m_func.group("params").strip()
                 params = [p.strip() for p in params_raw.split(",") if p.strip()] if params_raw else []
-                # Collect until '以上。'
-                func_depth = 1
-                loop_depth = 0
-                if_depth = 0
-                block_lines = []
-                j = i + 1
-                while j < len(lines):
-                    candidate_raw = lines[j].rstrip()
-                    candidate_norm = normalize_text(candidate_raw)
-                    if re.match(r"^(?:関数 )?[^\s()]+\([^)]*\) を(?:関数として)?定義する。?$", candidate_norm):
-                        func_depth += 1
-                        block_lines.append(candidate_raw)
-                        j += 1
-                        continue
-                    if self._re_loop_start.match(candidate_norm):
-                        loop_depth += 1
-                        block_lines.append(candidate_raw)
-                        j += 1
-                        continue
-                    if self._re_if_zero.match(candidate_norm) or self._re_if_nonzero.match(candidate_norm):
-                        if_depth += 1
-                        block_lines.append(candidate_raw)
-                        j += 1
-                        continue
-                    if self._re_else.match(candidate_norm):
-                        if_depth += 1
-                        block_lines.append(candidate_raw)
-                        j += 1
-                        continue
-                    if self._re_loop_end.match(candidate_norm):
-                        if loop_depth > 0:
-                            loop_depth -= 1
-                            block_lines.append(candidate_raw)
-                            j += 1
-                            continue
-                        # else: this '以上。' may close the function
-                    if re.match(r"^以上。?$", candidate_norm) and loop_depth == 0:
-                        if if_depth > 0:
-                            if_depth -= 1
-                            block_lines.append(candidate_raw)
-                            j += 1
-                            continue
-                        func_depth -= 1
-                        if func_depth == 0:
-                            break
-                        else:
-                            # Nested function end
-                            block_lines.append(candidate_raw)
-                            j += 1
-                            continue
-                    block_lines.append(candidate_raw)
-                    j += 1
-                if func_depth != 0:
+                j = jumps.get(i)
+                if j is None:
                     raise SyntaxError(f"関数 {fname} の定義に対応する『以上。』が見つかりません (行 {lineno})")
-                self.funcs[fname] = {"params": params, "body": block_lines}
+                body = self._compile_range(lines, norm, jumps, i + 1, j)
+                param_slots = [self._slot(p) for p in params]
+                frame = list(dict.fromkeys(param_slots + self._written_slots(body)))
+                code.append((OP_FUNC, fname, params, body, param_slots, frame))
                 i = j + 1
                 continue
-            # Loop block handling
-            m_loop = self._re_loop_start.match(line)
-            if m_loop:
-                count_expr = m_loop.group("count").strip()
-                # Collect block lines until matching 以上。
-                depth = 1
-                block_lines = []
-                j = i + 1
-                while j < len(lines):
-                    candidate_raw = lines[j].rstrip()
-                    candidate_norm = normalize_text(candidate_raw)
-                    if re.match(r"^(?:関数 )?[^\s()]+\([^)]*\) を(?:関数として)?定義する。?$", candidate_norm):
-                        depth += 1
-                    elif self._re_loop_start.match(candidate_norm):
-                        depth += 1
-                    elif self._re_if_zero.match(candidate_norm) or self._re_if_nonzero.match(candidate_norm):
-                        depth += 1
-                    elif self._re_else.match(candidate_norm):
-                        depth += 1
-                    elif self._re_loop_end.match(candidate_norm):
-                        depth -= 1
-                        if depth == 0:
-                            break
-                        else:
-                            j += 1
-                            continue
-                    block_lines.append(candidate_raw)
-                    j += 1
-                if depth != 0:
+            # Loop block: N 回、以下を行う。 ... 以上。
+            if kind == "loop":
+                m_loop = self._re_loop_start.match(line)
+                j = jumps.get(i)
+                if j is None:
+                    raise SyntaxError(f"対応する『以上。』が見つかりません (行 {lineno})")
+                body = self._compile_range(lines, norm, jumps, i + 1, j)
+                numeric = self._compile_numeric(body)
+                code.append((OP_LOOP, m_loop.group("count").strip(), body, lineno, numeric))
+                known.clear()
+                i = j + 1
+                continue
+            # If block, optionally followed by an ELSE block
+            if kind == "if0" or kind == "ifnz":
+                m_if = (self._re_if_zero if kind == "if0" else self._re_if_nonzero).match(line)
+                cond_expr = m_if.group("expr").strip()
+                j = jumps.get(i)
+                if j is None:
                     raise SyntaxError(f"対応する『以上。』が見つかりません (行 {lineno})")
-                # Execute block
+                then_body = self._compile_range(lines, norm, jumps, i + 1, j)
+                else_body: list[Instr] = []
+                k = j + 1
+                # Skip blank lines
+                while k < stop and not norm[k]:
+                    k += 1
+                m_else = self._re_structural.match(norm[k]) if k < stop else None
+                if m_else and m_else.lastgroup == "else":
+                    end = jumps.get(k)
+                    if end is None:
+                        raise SyntaxError(f"対応する『以上。』が見つかりません (行 {lineno})")
+                    else_body = self._compile_range(lines, norm, jumps, k + 1, end)
+                    j = end
+                code.append((OP_IF, cond_expr, then_body, else_body, kind == "if0", lineno))
+                known.clear()
+                i = j + 1
+                continue
+            instr = self._compile_line(lines[i].rstrip(), lineno)
+            if instr is not None:
+                code.append(self._fold(instr, known))
+            i += 1
+        return code
+
+    def _written_slots(self, code: list[Instr]) -> list[int]:
+        """Slots assigned by ``code``, including inside nested loops and ifs.
+
+        Nested function definitions are skipped; their calls restore their own
+        slots.
+        """
+        slots: list[int] = []
+        for instr in code:
+            op = instr[0]
+            if op == OP_ASSIGN or op == OP_ASSIGN_CONST:
+                slots.append(instr[1])
+            elif op in _ARITH:
+                slots.append(instr[3])
+            elif op == OP_LOOP:
+                slots.extend(self._written_slots(instr[2]))
+            elif op == OP_IF:
+                slots.extend(self._written_slots(instr[2]))
+                slots.extend(self._written_slots(instr[3]))
+        return slots
+
+    def _constant(self, token: str, known: Dict[int, Any]) -> Tuple[bool, Any]:
+        tag, payload = self._token(token)
+        if tag == TOK_CONST:
+            return True, payload
+        if tag == TOK_VAR and payload in known:
+            return True, known[payload]
+        return False, None
+
+    @staticmethod
+    def _foldable(value: Any) -> bool:
+        if type(value) is int:
+            return value.bit_length() <= _FOLD_MAX_BITS
+        return type(value) is float
+
+    def _fold(self, instr: Instr, known: Dict[int, Any]) -> Instr:
+        """Replace assignments whose value is known at compile time with
+        OP_ASSIGN_CONST, and keep ``known`` up to date for the next line."""
+        op = instr[0]
+        if op == OP_ASSIGN:
+            target = instr[1]
+            ok, val = self._constant(instr[2], known)
+        elif op in _ARITH:
+            target = instr[3]
+            ok_x, xv = self._constant(instr[1], known)
+            ok_y, yv = self._constant(instr[2], known)
+            ok = ok_x and ok_y and self._foldable(xv) and self._foldable(yv)
+            if ok and op == OP_MUL and type(xv) is int and type(yv) is int:
+                ok = xv.bit_length() + yv.bit_length() <= _FOLD_MAX_BITS
+            if ok:
+                try:
+                    val = _ARITH[op](xv, yv)
+                except ArithmeticError:
+                    # e.g. division by zero; leave it to be raised at run time
+                    ok = False
+                else:
+                    ok = self._foldable(val)
+        else:
+            return instr
+        if not ok:
+            known.pop(target, None)
+            return instr
+        known[target] = val
+        return (OP_ASSIGN_CONST, target, val, instr[-2], instr[-1])
+
+    def _compile_numeric(self, body: list[Instr]) -> Optional[Tuple[Any, Dict[int, Instr]]]:
+        """Translate a loop body made only of numeric assignments and arithmetic
+        into a Python function running the whole loop on local variables.
+
+        Returns ``(fn, line_map)`` or None when the body does not qualify.
+        ``fn(env, count)`` returns False without touching ``env`` when a
+        variable read by the body is undefined or not a number, in which case
+        the caller falls back to ``_run``. ``line_map`` maps line numbers of the
+        generated source back to the instruction executed there.
+        """
+        if not body:
+            return None
+        local_of: Dict[int, str] = {}
+        loaded: list[int] = []
+        # Constants reach the generated code as globals c0, c1, ... rather than
+        # as source text, which not every value can round-trip through.
+        consts: Dict[str, Any] = {}
+
+        def literal(value: Any) -> Optional[str]:
+            if type(value) not in _NUM:
+                return None
+            name = f"c{len(consts)}"
+            consts[name] = value
+            return name
+
+        def operand(token: str) -> Optional[str]:
+            tag, payload = self._token(token)
+            if tag == TOK_CONST:
+                return literal(payload)
+            if tag != TOK_VAR:
+                return None
+            if payload not in local_of:
+                local_of[payload] = f"v{len(local_of)}"
+                loaded.append(payload)
+            return local_of[payload]
+
+        symbol = {OP_ADD: "+", OP_SUB: "-", OP_MUL: "*", OP_DIV: "/"}
+        stmts: list[Tuple[str, Instr]] = []
+        for instr in body:
+            if instr[0] == OP_ASSIGN:
+                target, rhs = instr[1], operand(instr[2])
+            elif instr[0] == OP_ASSIGN_CONST:
+                target, rhs = instr[1], literal(instr[2])
+            elif instr[0] in symbol:
+                x, y = operand(instr[1]), operand(instr[2])
+                target, rhs = instr[3], None if x is None or y is None else f"{x} {symbol[instr[0]]} {y}"
+            else:
+                return None
+            if rhs is None:
+                return None
+            if target not in local_of:
+                local_of[target] = f"v{len(local_of)}"
+            stmts.append((f"{local_of[target]} = {rhs}", instr))
+
+        written = dict.fromkeys(instr[3] if instr[0] in symbol else instr[1] for _, instr in stmts)
+        src = ["def _loop(env, count):"]
+        if loaded:
+            src.extend(f"    {local_of[slot]} = env[{slot}]" for slot in loaded)
+            # Unassigned slots hold _UNSET, which fails the type check too
+            checks = " or ".join(f"type({local_of[slot]}) not in _NUM" for slot in loaded)
+            src.append(f"    if {checks}:")
+            src.append("        return False")
+        unset = [local_of[slot] for slot in written if slot not in loaded]
+        if unset:
+            src.append(f"    {' = '.join(unset)} = _UNSET")
+        src.append("    try:")
+        src.append("        for _ in range(count):")
+        line_map: Dict[int, Instr] = {}
+        for text, instr in stmts:
+            src.append(f"            {text}")
+            line_map[len(src)] = instr
+        src.append("    finally:")
+        for slot in written:
+            if slot in loaded:
+                src.append(f"        env[{slot}] = {local_of[slot]}")
+            else:
+                src.append(f"        if {local_of[slot]} is not _UNSET:")
+                src.append(f"            env[{slot}] = {local_of[slot]}")
+        src.append("    return True")
+
+        namespace: Dict[str, Any] = {"_NUM": _NUM, "_UNSET": _UNSET, **consts}
+        exec(compile("\n".join(src), "<keiyaku>", "exec"), namespace)
+        return namespace["_loop"], line_map
+
+    def _run(self, code: list[Instr], is_toplevel: bool = False) -> None:
+        for instr in code:
+            op = instr[0]
+            if op == OP_LOOP:
+                _, count_expr, body, lineno, numeric = instr
                 count_val = self._value_of(count_expr)
                 if not isinstance(count_val, (int, float)):
                     raise TypeError(f"反復回数は数値である必要があります (行 {lineno})")
                 count_int = int(count_val)
                 if count_int < 0:
                     raise ValueError(f"反復回数は負にできません (行 {lineno})")
-                block_src = "\n".join(block_lines)
+                if numeric is not None:
+                    fn, line_map = numeric
+                    try:
+                        if fn(self.env, count_int):
+                            continue
+                    except Exception as e:
+                        tb = e.__traceback__
+                        while tb is not None and tb.tb_frame.f_code is not fn.__code__:
+                            tb = tb.tb_next
+                        if tb is None:
+                            raise
+                        failed = line_map[tb.tb_lineno]
+                        raise type(e)(f"{e} (行 {failed[-2]}: {failed[-1]})") from e
+                run = self._run
                 for _ in range(count_int):
-                    self.exec(block_src)
-                # Move index past the end marker
-                i = j + 1
-                continue
-            # If block handling
-            m_if0 = self._re_if_zero.match(line)
-            m_ifnz = self._re_if_nonzero.match(line)
-            if m_if0 or m_ifnz:
-                cond_expr = (m_if0 or m_ifnz).group("expr").strip()
-                # Collect THEN block until matching 以上。
-                depth = 1
-                then_lines: list[str] = []
-                j = i + 1
-                while j < len(lines):
-                    candidate_raw = lines[j].rstrip()
-                    candidate_norm = normalize_text(candidate_raw)
-                    if re.match(r"^(?:関数 )?[^\s()]+\([^)]*\) を(?:関数として)?定義する。?$", candidate_norm):
-                        depth += 1
-                        then_lines.append(candidate_raw)
-                        j += 1
-                        continue
-                    if self._re_loop_start.match(candidate_norm):
-                        depth += 1
-                        then_lines.append(candidate_raw)
-                        j += 1
-                        continue
-                    if self._re_if_zero.match(candidate_norm) or self._re_if_nonzero.match(candidate_norm):
-                        depth += 1
-                        then_lines.append(candidate_raw)
-                        j += 1
-                        continue
-                    if self._re_loop_end.match(candidate_norm):
-                        depth -= 1
-                        if depth == 0:
-                            break
-                        then_lines.append(candidate_raw)
-                        j += 1
-                        continue
-                    then_lines.append(candidate_raw)
-                    j += 1
-                if depth != 0:
-                    raise SyntaxError(f"対応する『以上。』が見つかりません (行 {lineno})")
-                # Optionally collect ELSE block if present next
-                k = j + 1
-                # Skip blank lines
-                while k < len(lines) and not normalize_text(lines[k].rstrip()):
-                    k += 1
-                else_lines: list[str] | None = None
-                if k < len(lines):
-                    next_norm = normalize_text(lines[k].rstrip())
-                    if self._re_else.match(next_norm):
-                        # Collect ELSE block similar to THEN
-                        depth2 = 1
-                        else_lines = []
-                        k += 1
-                        while k < len(lines):
-                            cand_raw2 = lines[k].rstrip()
-                            cand_norm2 = normalize_text(cand_raw2)
-                            if re.match(r"^(?:関数 )?[^\s()]+\([^)]*\) を(?:関数として)?定義する。?$", cand_norm2):
-                                depth2 += 1
-                                else_lines.append(cand_raw2)
-                                k += 1
-                                continue
-                            if self._re_loop_start.match(cand_norm2):
-                                depth2 += 1
-                                else_lines.append(cand_raw2)
-                                k += 1
-                                continue
-                            if self._re_if_zero.match(cand_norm2) or self._re_if_nonzero.match(cand_norm2):
-                                depth2 += 1
-                                else_lines.append(cand_raw2)
-                                k += 1
-                                continue
-                            if self._re_loop_end.match(cand_norm2):
-                                depth2 -= 1
-                                if depth2 == 0:
-                                    break
-                                else_lines.append(cand_raw2)
-                                k += 1
-                                continue
-                            else_lines.append(cand_raw2)
-                            k += 1
-                        if depth2 != 0:
-                            raise SyntaxError(f"対応する『以上。』が見つかりません (行 {lineno})")
-                # Evaluate and execute
+                    run(body)
+            elif op == OP_IF:
+                _, cond_expr, then_body, else_body, is_zero, lineno = instr
                 cond_val = self._value_of(cond_expr)
                 if not isinstance(cond_val, (int, float)):
                     raise TypeError(f"条件式は数値である必要があります (行 {lineno})")
-                is_true = (cond_val == 0) if m_if0 else (cond_val != 0)
-                exec_src = "\n".join(then_lines if is_true else (else_lines or []))
-                if exec_src:
-                    self.exec(exec_src)
-                # Advance index past THEN (and ELSE if existed)
-                i = (k if else_lines is not None else j) + 1
-                continue
-            # Normal single-line execution
-            try:
-                self.exec_line(raw_s)
-                if is_toplevel:
-                    self._toplevel_effect = True
-            except KeiyakuInterpreter._ReturnSignal:
-                # Propagate function return without wrapping
-                raise
-            except Exception as e:
-                raise type(e)(f"{e} (行 {lineno}: {raw_s})") from e
-            i += 1
+                is_true = (cond_val == 0) if is_zero else (cond_val != 0)
+                self._run(then_body if is_true else else_body)
+            elif op == OP_FUNC:
+                _, fname, params, compiled, slots, frame = instr
+                self.funcs[fname] = {"params": params, "compiled": compiled, "slots": slots, "frame": frame}
+            else:
+                try:
+                    self._exec_simple(instr)
+                    if is_toplevel:
+                        self._toplevel_effect = True
+                except KeiyakuInterpreter._ReturnSignal:
+                    # Propagate function return without wrapping
+                    raise
+                except Exception as e:
+                    raise type(e)(f"{e} (行 {instr[-2]}: {instr[-1]})") from e
+
+    def exec(self, program: str, *, is_toplevel: bool = False) -> None:
+        # Batch prints into larger writes unless a terminal is watching
+        self._buffer_output = not sys.stdout.isatty()
+        try:
+            self._run(self._compile_block(program.splitlines()), is_toplevel)
+        finally:
+            self._flush_output()
 
 
 def 主文(argv: list[str]) -> int:
@@ -435,7 +615,10 @@ def 主文(argv: list[str]) -> int:
     interp.exec(src, is_toplevel=True)
     # Auto-call 主文() if defined and no toplevel effects
     if "主文" in interp.funcs and not interp._toplevel_effect:
-        _ = interp._call_function("主文", [])
+        try:
+            _ = interp._call_function("主文", [])
+        finally:
+            interp._flush_output()
     return 0
 
 